@@ -3,7 +3,12 @@ This module provides functions to process and visualize Manhattan plots for geno
 
 Functions:
 - compute_relative_pos: Compute relative positions and -log10(p-values) for SNPs.
+- neg_log10: Compute -log10(p-values) as float32.
+- chromosome_codes: Map chromosome identifiers to integer codes in genomic order.
+- chromosome_lengths: Length of each chromosome in genomic order.
+- thin_sumstats: Drop non-significant SNPs that would be drawn on top of each other.
 - find_chromosomes_center: Calculate center positions of chromosomes.
+- chromosome_scatter: Draw all SNPs in a single scatter with alternating chromosome colors.
 - process_manhattan_data: Prepare data for Manhattan plot visualization.
 - draw_manhattan: Generate and save a Manhattan plot with optional SNP highlighting and annotation.
 """
@@ -17,16 +22,17 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
-import textalloc as ta
 
 from matplotlib.axes import Axes
 from matplotlib.backend_bases import RendererBase
+from matplotlib.colors import ListedColormap
+from matplotlib.text import Annotation
 
 from gwaslab.bd_download import download_file
 from gwaslab.g_Log import Log
 from gwaslab.util_in_get_sig import annogene
 
-def compute_relative_pos(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS', p_col:str='p')->pd.DataFrame:
+def compute_relative_pos(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS', p_col:str='p', chr_lengths:pd.Series=None)->pd.DataFrame:
     
     """
     Compute the relative position of probes/SNPs across chromosomes and add a -log10(p-value) column.
@@ -41,6 +47,8 @@ def compute_relative_pos(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS'
         Column name for base pair positions. Default is 'POS'.
     p_col (str): 
         Column name for p-values. Default is 'p'.
+    chr_lengths (pd.Series):
+        Chromosome lengths as returned by `chromosome_lengths`, e.g. computed on the full data when `data` was thinned. Default is None, the lengths of `data`.
     
     Returns:
     --------
@@ -56,28 +64,193 @@ def compute_relative_pos(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS'
     if p_col not in data.columns:
         raise ValueError(f"Column '{p_col}' not found in the input DataFrame.")
 
-    # Group by chromosome and compute chromosome size
-    chr_grouped = data.groupby(chr_col).agg(chrlength=(pos_col, 'max')).reset_index()
+    # Sort by chromosome (in genomic order) and position
+    codes = chromosome_codes(data[chr_col])
+    order = np.lexsort((data[pos_col].values, codes))
 
-    # Calculate cumulative chromosome length
-    chr_grouped['cumulativechrlength'] = chr_grouped['chrlength'].cumsum() - chr_grouped['chrlength']
+    data  = data.iloc[order].reset_index(drop=True)
+    codes = codes[order]
 
-    # Merge cumulative chromosome length back to the original data
-    data = pd.merge(data, chr_grouped[[chr_col, 'cumulativechrlength']], on=chr_col)
-
-    # Sort by chromosome and position
-    data = data.sort_values(by=[chr_col, pos_col])
+    if chr_lengths is None:
+        chr_lengths = chromosome_lengths(data, chr_col=chr_col, pos_col=pos_col)
 
     # Add the relative position of the probe/snp
-    data['rel_pos'] = data[pos_col] + data['cumulativechrlength']
-
-    # Drop cumulative chromosome length column
-    data = data.drop(columns=['cumulativechrlength'])
+    data['rel_pos'] = _genome_positions(codes, data[pos_col].values, chr_lengths)
 
-    data['log10p']= -np.log10(data[p_col])
+    data['log10p'] = neg_log10(data[p_col].values)
 
     return data
 
+def neg_log10(pvalues:np.ndarray)->np.ndarray:
+
+    """
+    Compute the -log10 of p-values into a new float32 array, which is enough precision for plotting and halves the memory traffic of float64. The input is left untouched, so callers compute it on the rows they actually plot.
+
+    Parameters:
+    -----------
+    pvalues (np.ndarray):
+        Array of p-values.
+
+    Returns:
+    --------
+    np.ndarray: The -log10(p-values) as float32.
+    """
+
+    log10p = np.empty(len(pvalues), dtype=np.float32)
+
+    np.log10(pvalues, out=log10p)
+    np.negative(log10p, out=log10p)
+
+    return log10p
+
+def chromosome_lengths(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS')->pd.Series:
+
+    """
+    Length of each chromosome, taken as the position of its last SNP, indexed by the codes of `chromosome_codes` in genomic order.
+
+    Parameters:
+    -----------
+    data (pd.DataFrame):
+        Input DataFrame containing genomic data.
+    chr_col (str):
+        Column name for chromosome identifiers. Default is 'CHR'.
+    pos_col (str):
+        Column name for base pair positions. Default is 'POS'.
+
+    Returns:
+    --------
+    pd.Series: Length of each chromosome.
+    """
+
+    return pd.Series(data[pos_col].values).groupby(chromosome_codes(data[chr_col])).max()
+
+def _genome_positions(codes:np.ndarray, pos:np.ndarray, chr_lengths:pd.Series)->np.ndarray:
+
+    """
+    Position along the genome of SNPs given by chromosome code and base pair position, the chromosomes being laid end to end in genomic order.
+    """
+
+    cumulative = (chr_lengths.cumsum() - chr_lengths).values
+
+    return pos + cumulative[np.searchsorted(chr_lengths.index.values, codes)]
+
+def chromosome_codes(chrom:pd.Series)->np.ndarray:
+
+    """
+    Map chromosome identifiers to integer codes in genomic order: 1-22, X (23), Y (24), XY (25) and MT (26). Identifiers may be numbers or strings, with or without a 'chr' prefix. Unrecognized identifiers are placed after MT in lexicographic order.
+
+    Parameters:
+    -----------
+    chrom : pd.Series
+        Chromosome identifiers.
+
+    Returns:
+    --------
+    np.ndarray: Integer code of each chromosome identifier.
+    """
+
+    named = {'X': 23, 'Y': 24, 'XY': 25, 'MT': 26, 'M': 26}
+
+    # map the few distinct identifiers, then broadcast back to every row
+    inverse, uniques = pd.factorize(chrom)
+
+    unique_codes = np.empty(len(uniques), dtype=np.int64)
+    unknown      = []
+
+    for i, label in enumerate(uniques):
+
+        name = str(label).upper()
+        name = name[3:] if name.startswith('CHR') else name
+        name = name[:-2] if name.endswith('.0') else name
+
+        if name.isdigit():
+            unique_codes[i] = int(name)
+        elif name in named:
+            unique_codes[i] = named[name]
+        else:
+            unknown.append((name, i))
+
+    for rank, (_, i) in enumerate(sorted(unknown)):
+        unique_codes[i] = 27 + rank
+
+    return unique_codes[inverse]
+
+def thin_sumstats(data:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS', p_col:str='p', p_threshold:float=1e-2, x_bins:int=1000, y_step:float=0.02, chr_lengths:pd.Series=None, snp_col:str=None, keep_snps:list=None)->pd.DataFrame:
+
+    """
+    Thin the summary statistics before plotting. All SNPs with p-value below `p_threshold` are kept, while the remaining ones, which pile up at the bottom of a Manhattan plot, are reduced to one SNP per cell of a grid of `x_bins` columns along the genome and rows of `y_step` in -log10(p). The cells are smaller than a marker at the default figure size, so the plot looks the same as with all SNPs and its density does not change at the threshold. The thinning is deterministic.
+
+    Parameters:
+    -----------
+    data : pd.DataFrame
+        Input DataFrame containing genomic data.
+    chr_col : str, optional
+        Column name for chromosome identifiers. Default is 'CHR'.
+    pos_col : str, optional
+        Column name for base pair positions. Default is 'POS'.
+    p_col : str, optional
+        Column name for p-values. Default is 'p'.
+    p_threshold : float, optional
+        SNPs with p-value below this threshold are always kept. Default is 1e-2.
+    x_bins : int, optional
+        Number of grid columns along the genome. Default is 1000.
+    y_step : float, optional
+        Height of the grid rows in -log10(p). Default is 0.02.
+    chr_lengths : pd.Series, optional
+        Chromosome lengths as returned by `chromosome_lengths`, to lay the grid over several data sets at once. Default is None, the lengths of `data`.
+    snp_col : str, optional
+        Column name for SNP identifiers, needed with `keep_snps`. Default is None.
+    keep_snps : list, optional
+        SNP identifiers that are always kept, e.g. those to highlight or annotate. Default is None.
+
+    Returns:
+    --------
+    pd.DataFrame: DataFrame with the thinned SNPs.
+    """
+
+    if not isinstance(data, pd.DataFrame):
+        raise TypeError("Input data must be a pandas DataFrame.")
+    if chr_col not in data.columns:
+        raise ValueError(f"Column '{chr_col}' not found in the input DataFrame.")
+    if pos_col not in data.columns:
+        raise ValueError(f"Column '{pos_col}' not found in the input DataFrame.")
+    if p_col not in data.columns:
+        raise ValueError(f"Column '{p_col}' not found in the input DataFrame.")
+
+    pvalues = data[p_col].values
+
+    keep = pvalues < p_threshold
+
+    # SNPs to highlight or annotate are never dropped
+    if snp_col is not None and keep_snps is not None and len(keep_snps) > 0:
+        keep |= data[snp_col].isin(keep_snps).values
+
+    below = np.flatnonzero(~keep)
+    if len(below) == 0:
+        return data
+
+    if chr_lengths is None:
+        chr_lengths = chromosome_lengths(data, chr_col=chr_col, pos_col=pos_col)
+
+    # grid cell of every SNP below the threshold, SNPs without a p-value cannot be drawn and are dropped
+    x = _genome_positions(chromosome_codes(data[chr_col].values[below]), data[pos_col].values[below], chr_lengths)
+    y = neg_log10(pvalues[below])
+
+    drawn = np.isfinite(y)
+    below, x, y = below[drawn], x[drawn], y[drawn]
+
+    n_rows = int(np.ceil(-np.log10(p_threshold) / y_step)) + 1
+
+    x_cell = np.clip((x * (x_bins / chr_lengths.sum())).astype(np.int64), 0, x_bins-1)
+    y_cell = np.clip((y / y_step).astype(np.int64), 0, n_rows-1)
+
+    # first SNP of each occupied cell
+    _, first = np.unique(x_cell * n_rows + y_cell, return_index=True)
+
+    keep[below[first]] = True
+
+    return data[keep]
+
 def find_chromosomes_center(data:pd.DataFrame, chr_col:str='CHR', chr_pos_col:str='rel_pos')->pd.DataFrame:
     
     """
@@ -105,20 +278,58 @@ def find_chromosomes_center(data:pd.DataFrame, chr_col:str='CHR', chr_pos_col:st
     if chr_pos_col not in data.columns:
         raise ValueError(f"Column '{chr_pos_col}' not found in the input DataFrame.")
 
-    chromosomes = data[chr_col].unique()
+    # chromosomes are kept in order of appearance
+    limits = data.groupby(chr_col, sort=False)[chr_pos_col].agg(['min', 'max'])
 
-    axis_center = pd.DataFrame(columns=[chr_col, 'center'])
+    axis_center = pd.DataFrame({
+        chr_col : limits.index,
+        'center': np.round((limits['max']+limits['min'])/2, 0).values
+    })
 
-    for i, chrom in enumerate(chromosomes):
+    return axis_center
 
-        temp = data[data[chr_col] == chrom].reset_index(drop=True)
+def chromosome_scatter(axes:Axes, data:pd.DataFrame, chr_col:str, chr_colors:list, s:float=3)->Axes:
 
-        axis_center.loc[i, chr_col] = chrom
-        axis_center.loc[i, 'center'] = np.round((temp[chr_pos_col].max()+temp[chr_pos_col].min())/2,0)
+    """
+    Draws all SNPs of a Manhattan-type plot as a single scatter, alternating colors between consecutive chromosomes. The scatter is rasterized, so vector outputs (pdf, svg) do not store one path per SNP.
 
-    return axis_center
+    Parameters:
+    -----------
+    axes : Axes (matplotlib.axes.Axes)
+        The matplotlib axes object where the plot is drawn.
+    data : pd.DataFrame
+        DataFrame sorted by chromosome with columns 'rel_pos' and 'log10p'.
+    chr_col : str
+        The column name for chromosome identifiers.
+    chr_colors : list
+        Colors to cycle through along the chromosomes.
+    s : float, optional
+        Marker size. Default is 3.
+
+    Returns:
+    --------
+    Axes
+        The matplotlib axes object with the scatter plot.
+    """
 
-def manhattan_process_data(data_df:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS', p_col:str='p')->dict:
+    # one color index per SNP, cycling with the order of appearance of the chromosomes
+    color_idx = pd.factorize(data[chr_col])[0] % len(chr_colors)
+
+    axes.scatter(
+        data['rel_pos'].values,
+        data['log10p'].values,
+        c         =color_idx,
+        cmap      =ListedColormap(chr_colors),
+        vmin      =0,
+        vmax      =len(chr_colors)-1,
+        s         =s,
+        linewidths=0,
+        rasterized=True
+    )
+
+    return axes
+
+def manhattan_process_data(data_df:pd.DataFrame, chr_col:str='CHR', pos_col:str='POS', p_col:str='p', snp_col:str=None, keep_snps:list=None)->dict:
     
     """
     Processes the input DataFrame to prepare data for a Manhattan plot.
@@ -133,6 +344,10 @@ def manhattan_process_data(data_df:pd.DataFrame, chr_col:str='CHR', pos_col:str=
         The column name for position data. Defaults to 'POS'.
     p_col : str (optional)
         The column name for p-value data. Defaults to 'p'.
+    snp_col : str (optional)
+        The column name for SNP identifiers. Defaults to None.
+    keep_snps : list (optional)
+        SNP identifiers kept when thinning the data, e.g. those to highlight or annotate. Defaults to None.
 
     Returns:
     --------
@@ -151,11 +366,15 @@ def manhattan_process_data(data_df:pd.DataFrame, chr_col:str='CHR', pos_col:str=
     if p_col not in data_df.columns:
         raise ValueError(f"Column '{p_col}' not found in the input DataFrame.")
 
+    # chromosome lengths of the full data, so that thinning does not move the chromosome boundaries
+    chr_lengths = chromosome_lengths(data_df, chr_col=chr_col, pos_col=pos_col)
+
     data = compute_relative_pos(
-        data_df, 
-        chr_col=chr_col, 
-        pos_col=pos_col, 
-        p_col  =p_col
+        thin_sumstats(data_df, chr_col=chr_col, pos_col=pos_col, p_col=p_col, chr_lengths=chr_lengths, snp_col=snp_col, keep_snps=keep_snps), 
+        chr_col    =chr_col, 
+        pos_col    =pos_col, 
+        p_col      =p_col,
+        chr_lengths=chr_lengths
     )
 
     axis_center = find_chromosomes_center(data, chr_col=chr_col)
@@ -170,7 +389,7 @@ def manhattan_process_data(data_df:pd.DataFrame, chr_col:str='CHR', pos_col:str=
 
     return manhattan_data
 
-def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str, p_col:str, plot_dir:str, to_highlight:pd.DataFrame=pd.DataFrame(), highlight_hue:str='hue', to_annotate:pd.DataFrame=pd.DataFrame(), gen_col:str=None, build:str='38', gtf_path:str=None, save_name:str='manhattan_plot.jpeg')->bool:
+def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str, p_col:str, plot_dir:str, to_highlight:pd.DataFrame=pd.DataFrame(), highlight_hue:str='hue', to_annotate:pd.DataFrame=pd.DataFrame(), gen_col:str=None, build:str='38', gtf_path:str=None, save_name:str='manhattan_plot.jpeg', dpi:int=150, ax:Axes=None)->bool:
 
     """
     Draws a Manhattan plot for visualizing GWAS results.
@@ -199,6 +418,10 @@ def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str,
         The path to the GTF file for gene annotation. If None, the file will be downloaded. Default is None.
     save_name : str, optional
         The name of the file to save the plot as. Default is 'manhattan_plot.jpeg'.
+    dpi : int, optional
+        Resolution of the saved plot. Default is 150, a 2250x1500 px image. Raise it for print quality at the cost of a larger canvas and a slower save.
+    ax : Axes, optional
+        Axes to draw the plot into. When given, no figure is created and nothing is saved, so the plot can be composed with others by the caller. Default is None.
 
     Returns:
     --------
@@ -231,7 +454,7 @@ def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str,
     if p_col not in data_df.columns:
         raise ValueError(f"Column '{p_col}' not found in the input DataFrame.")
     
-    if not os.path.exists(plot_dir):
+    if ax is None and not os.path.exists(plot_dir):
         raise FileNotFoundError(f"Directory '{plot_dir}' not found.")
     
     chr_colors           = ['#66c2a5', '#fc8d62']
@@ -243,32 +466,33 @@ def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str,
     suggestive_line_color= "#377eb8"
 
     # format data to draw manhattan plot
+    # SNPs to highlight or annotate must survive the thinning of the data
+    keep_snps = []
+    for df_snps in [to_highlight, to_annotate]:
+        if df_snps is not None and snp_col in df_snps.columns:
+            keep_snps += df_snps[snp_col].tolist()
+
     plot_data = manhattan_process_data(
-        data_df=data_df,
-        chr_col=chr_col,
-        pos_col=pos_col,
-        p_col  =p_col
+        data_df  =data_df,
+        chr_col  =chr_col,
+        pos_col  =pos_col,
+        p_col    =p_col,
+        snp_col  =snp_col,
+        keep_snps=keep_snps
     )
 
     max_x_axis = plot_data['data']['rel_pos'].max()
 
-    # Create the figure
-    fig= plt.figure(figsize=(15, 10))
-    ax = fig.add_subplot(111)
+    # Create the figure, unless drawing into the caller's axes
+    own_figure = ax is None
+    if own_figure:
+        fig= plt.figure(figsize=(15, 10))
+        ax = fig.add_subplot(111)
 
     # Suppress warnings about the number of chromosomes and just two colors
     warnings.filterwarnings("ignore", category=UserWarning)
 
-    ax = sns.scatterplot(
-        x      =plot_data['data']['rel_pos'], 
-        y      =plot_data['data']['log10p'],
-        hue    =plot_data['data'][chr_col], 
-        palette=chr_colors, 
-        ax     =ax, 
-        s      =3, 
-        legend =False,
-        edgecolor='none'
-    )
+    ax = chromosome_scatter(ax, plot_data['data'], chr_col=chr_col, chr_colors=chr_colors)
 
     # set axis labels and font size
     ax.set_ylabel(ylab, fontsize=7)
@@ -335,7 +559,8 @@ def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str,
                         edgecolor="black"
                     )
                 
-    plt.tight_layout()
+    if own_figure:
+        plt.tight_layout()
 
     # annotate SNPs   
     if to_annotate is not None and to_annotate.empty is not True:
@@ -388,17 +613,23 @@ def manhattan_draw(data_df:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str,
             genome_line    =genome_line
         )
 
+    # the caller saves and closes its own figure
+    if not own_figure:
+        return True
 
     # save the plot
 
-    plt.savefig(
-        os.path.join(plot_dir, save_name), dpi=600
+    fig.savefig(
+        os.path.join(plot_dir, save_name), dpi=dpi
     )
     plt.show()
 
+    # release the canvas
+    plt.close(fig)
+
     return True
 
-def miami_process_data(data_top:pd.DataFrame, data_bottom:pd.DataFrame, chr_col:str, pos_col:str, p_col:str)->dict:
+def miami_process_data(data_top:pd.DataFrame, data_bottom:pd.DataFrame, chr_col:str, pos_col:str, p_col:str, snp_col:str=None, keep_snps:list=None)->dict:
     
     """
     Processes Miami plot data by preparing, computing relative positions, and splitting the data.
@@ -409,6 +640,10 @@ def miami_process_data(data_top:pd.DataFrame, data_bottom:pd.DataFrame, chr_col:
         The top part of the data to be processed.
     data_bottom (pd.DataFrame): 
         The bottom part of the data to be processed.
+    snp_col (str):
+        The column name for SNP identifiers. Defaults to None.
+    keep_snps (list):
+        SNP identifiers kept in both parts when thinning the data, e.g. those to highlight or annotate. Defaults to None.
     
     Returns:
     --------
@@ -430,12 +665,18 @@ def miami_process_data(data_top:pd.DataFrame, data_bottom:pd.DataFrame, chr_col:
     if p_col not in data_top.columns:
         raise ValueError(f"Column '{p_col}' not found in the input DataFrame.")
 
-    data_top['split_by']   = 'top'
-    data_bottom['split_by']= 'bottom'
+    # chromosome lengths over both full data sets, shared by the thinning grid and the x-axis of both panels
+    chr_lengths = pd.concat([
+        chromosome_lengths(data_top, chr_col=chr_col, pos_col=pos_col),
+        chromosome_lengths(data_bottom, chr_col=chr_col, pos_col=pos_col)
+    ]).groupby(level=0).max()
+
+    data_top    = thin_sumstats(data_top, chr_col=chr_col, pos_col=pos_col, p_col=p_col, chr_lengths=chr_lengths, snp_col=snp_col, keep_snps=keep_snps).assign(split_by='top')
+    data_bottom = thin_sumstats(data_bottom, chr_col=chr_col, pos_col=pos_col, p_col=p_col, chr_lengths=chr_lengths, snp_col=snp_col, keep_snps=keep_snps).assign(split_by='bottom')
 
     data = pd.concat([data_top, data_bottom], axis=0, ignore_index=True)
 
-    data = compute_relative_pos(data, chr_col=chr_col, pos_col=pos_col, p_col=p_col)
+    data = compute_relative_pos(data, chr_col=chr_col, pos_col=pos_col, p_col=p_col, chr_lengths=chr_lengths)
 
     axis_center = find_chromosomes_center(data, chr_col=chr_col, chr_pos_col='rel_pos')
 
@@ -453,7 +694,7 @@ def miami_process_data(data_top:pd.DataFrame, data_bottom:pd.DataFrame, chr_col:
 def manhattan_type_annotate(axes:Axes, data:pd.DataFrame, variants_toanno:pd.DataFrame, max_x_axis:float, suggestive_line:float, genome_line:float)->Axes:
     
     """
-    Annotates a Manhattan plot with gene names.
+    Annotates a Manhattan plot with gene names. Labels are placed in a single pass over a grid of columns along the x-axis: variants are visited from the strongest to the weakest association and a label is drawn only if its column is still free, so weaker hits next to a stronger one are not labelled.
 
     Parameters:
     -----------
@@ -490,43 +731,50 @@ def manhattan_type_annotate(axes:Axes, data:pd.DataFrame, variants_toanno:pd.Dat
         raise TypeError("suggestive_line must be a float.")
     if not isinstance(genome_line, float):
         raise TypeError("genome_line must be a float.")
-    
-    x_lines_coor = np.linspace(0, max_x_axis, 1000).tolist() # list with a grid of x-coordinates for the lines
-    
-    texts = []  # a list to store text annotations for adjustment
-    x = []      # a list to store x-coordinates for adjustment
-    y = []      # a list to store y-coordinates for adjustment
-
-    for i, row in variants_toanno.iterrows():
-
-        x.append(row['rel_pos'])
-        y.append(row['log10p'])
-        texts.append(row['GENENAME'])
-
-    allocate = ta.allocate(
-            axes,              # the axis to which the text will be
-            x        =x,     # x-coordinates of the data point to annotate
-            y        =y,     # y-coordinates of the data point to annotate
-            text_list=texts, # list of text to annotate
-            x_scatter=data['rel_pos'], # all scatter points x-coordinates
-            y_scatter=data['log10p'],  # all scatter points y-coordinates
-            linecolor='black',                      # color of the line connecting the text to the data point
-            textsize =8,                            # size of the text (Default to Nature standard)
-            bbox     =dict(boxstyle='round,pad=0.3', edgecolor='black', facecolor='#f0f0f0', alpha=0.5),
-            x_lines  = [x_lines_coor, x_lines_coor],
-            y_lines  = [[-np.log10(suggestive_line)]*len(x_lines_coor), [-np.log10(genome_line)]*len(x_lines_coor)],
-            avoid_label_lines_overlap =True,
-            avoid_crossing_label_lines=False,
-            min_distance=0.01,
-            max_distance=0.4,
-            margin      =0.01,
-            rotation    =90,
-            nbr_candidates=300,
-            priority_strategy=42,
-            plot_kwargs=dict(linestyle=':')
-        )
 
-    text_objs = allocate[2]
+    x_bin = max_x_axis / 120 # width of the grid columns
+
+    # labels grow away from the point, downwards when the y-axis is inverted (lower Miami plot)
+    if axes.yaxis_inverted():
+        offset, va = -5, 'top'
+    else:
+        offset, va = 5, 'bottom'
+
+    bbox = dict(boxstyle='round,pad=0.3', edgecolor='black', facecolor='#f0f0f0', alpha=0.5)
+
+    # strongest associations first
+    order = np.argsort(-variants_toanno['log10p'].values, kind='stable')
+
+    x     = variants_toanno['rel_pos'].values[order]
+    y     = variants_toanno['log10p'].values[order]
+    genes = variants_toanno['GENENAME'].values[order]
+
+    occupied  = set()
+    labelled  = set()
+    text_objs = []
+
+    for x_val, y_val, gene in zip(x, y, genes):
+
+        cell = int(x_val // x_bin)
+        if cell in occupied or gene in labelled:
+            continue
+
+        occupied.add(cell)
+        labelled.add(gene)
+
+        text_objs.append(
+            axes.annotate(
+                gene,
+                xy        =(x_val, y_val),
+                xytext    =(0, offset),
+                textcoords='offset points',
+                rotation  =90,
+                ha        ='center',
+                va        =va,
+                fontsize  =8,
+                bbox      =bbox
+            )
+        )
         
     return axes, text_objs
 
@@ -551,25 +799,24 @@ def miami_draw_anno_lines(renderer:RendererBase, axes:Axes, texts:list, variants
     Axes: The axes with the annotation lines drawn.
     """
 
-    from math import dist
+    # coordinates of the first variant of each gene, looked up once instead of scanning per label
+    first = variants_toanno.drop_duplicates(subset='GENENAME')
+    gene_coords = dict(zip(first['GENENAME'], zip(first['rel_pos'], first['log10p'])))
 
-    for k in range(len(texts)):
+    for text_obj in texts:
 
-        text_obj = texts[k]
         bbox = text_obj.get_window_extent(renderer=renderer)
         
         # Transform to data coordinates the corners of the text bbox
         data_coords = axes.transData.inverted().transform(bbox.corners()) # list with coordinates of the text box
 
-        anno = text_obj.get_text()
-
-        data_x = variants_toanno.loc[variants_toanno['GENENAME'] == anno, 'rel_pos'].values[0]
-        data_y = variants_toanno.loc[variants_toanno['GENENAME'] == anno, 'log10p'].values[0]
+        # annotations already know the point they refer to
+        if isinstance(text_obj, Annotation):
+            data_x, data_y = text_obj.xy
+        else:
+            data_x, data_y = gene_coords[text_obj.get_text()]
 
-        closest_point = data_coords[0]
-        for point in data_coords:
-            if dist([data_x, data_y], point) < dist([data_x, data_y], closest_point):
-                closest_point = point 
+        closest_point = data_coords[np.argmin(np.hypot(data_coords[:, 0]-data_x, data_coords[:, 1]-data_y))]
 
         axes.plot(
             [data_x, closest_point[0]], 
@@ -581,7 +828,7 @@ def miami_draw_anno_lines(renderer:RendererBase, axes:Axes, texts:list, variants
 
     return axes
 
-def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str, p_col:str, plots_dir:str, top_highlights:list=[], top_annotations:pd.DataFrame=None, bottom_highlights:list=[], bottom_annotations:pd.DataFrame=None, top_gen_col:str=None, bottom_gen_col:str=None, gtf_path:str=None, save_name:str='miami_plot.jpeg', legend_top:str='top GWAS', legend_bottom:str='bottom GWAS')->bool:
+def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col:str, pos_col:str, p_col:str, plots_dir:str, top_highlights:list=[], top_annotations:pd.DataFrame=None, bottom_highlights:list=[], bottom_annotations:pd.DataFrame=None, top_gen_col:str=None, bottom_gen_col:str=None, gtf_path:str=None, save_name:str='miami_plot.jpeg', legend_top:str='top GWAS', legend_bottom:str='bottom GWAS', dpi:int=150)->bool:
     
     """
     Draws a Miami plot (a combination of two Manhattan plots) for visualizing GWAS results.
@@ -614,6 +861,8 @@ def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col
         Path to the GTF file for gene annotation. If None, the file will be downloaded.
     save_name : str, optional
         Name of the file to save the plot as. Default is 'miami_plot.jpeg'.
+    dpi : int, optional
+        Resolution of the saved plot. Default is 150, a 3000x1950 px image. Raise it for print quality at the cost of a larger canvas and a slower save.
     Returns:
     --------
     bool
@@ -665,7 +914,13 @@ def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col
     warnings.filterwarnings("ignore", category=UserWarning)
 
     # format data to draw miami plot
-    plot_data = miami_process_data(df_top, df_bottom, chr_col=chr_col, pos_col=pos_col, p_col=p_col)
+    # highlighted SNPs are drawn in both panels, so they and the annotated ones must survive the thinning of both
+    keep_snps = list(top_highlights) + list(bottom_highlights)
+    for df_snps in [top_annotations, bottom_annotations]:
+        if snp_col in df_snps.columns:
+            keep_snps += df_snps[snp_col].tolist()
+
+    plot_data = miami_process_data(df_top, df_bottom, chr_col=chr_col, pos_col=pos_col, p_col=p_col, snp_col=snp_col, keep_snps=keep_snps)
 
     # Set axis labels for upper and lower plot
     def format_ylabel(label):
@@ -676,23 +931,11 @@ def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col
 
     max_x_axis = max(plot_data['upper']['rel_pos'].max(), plot_data['lower']['rel_pos'].max())+10
 
-    # Create the figure
-    fig = plt.figure(figsize=(20, 13))
-
-    # Create the upper plot
+    # Create the figure with both panels, the x-axes are not shared as only the upper one has tick labels
+    fig, (ax_upper, ax_lower) = plt.subplots(2, 1, figsize=(20, 13))
 
-    ax_upper = plt.subplot(211)
-
-    sns.scatterplot(
-        x      =plot_data['upper']['rel_pos'], 
-        y      =plot_data['upper']['log10p'],
-        hue    =plot_data['upper'][chr_col], 
-        palette=chr_colors, 
-        ax     =ax_upper, 
-        s      =3, 
-        legend =False,
-        edgecolor='none'
-    )
+    # Draw the upper plot
+    chromosome_scatter(ax_upper, plot_data['upper'], chr_col=chr_col, chr_colors=chr_colors)
     ax_upper.set_ylabel(upper_ylab)
     ax_upper.set_xlim(0, max_x_axis)
 
@@ -709,18 +952,8 @@ def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col
     if genome_line is not None:
         ax_upper.axhline(-np.log10(genome_line), color=genome_line_color, linestyle='dashed', lw=0.7)
 
-    # Create the lower plot
-    ax_lower = plt.subplot(212)
-    sns.scatterplot(
-        x      =plot_data['lower']['rel_pos'], 
-        y      =plot_data['lower']['log10p'],
-        hue    =plot_data['lower'][chr_col], 
-        palette=chr_colors, 
-        ax     =ax_lower, 
-        s      =3, 
-        legend =False,
-        edgecolor='none'
-    )
+    # Draw the lower plot
+    chromosome_scatter(ax_lower, plot_data['lower'], chr_col=chr_col, chr_colors=chr_colors)
     ax_lower.set_ylabel(lower_ylab)
     ax_lower.set_ylim(plot_data['maxp'], 0)  # Reverse y-axis
     ax_lower.set_xlim(0, max_x_axis)
@@ -942,7 +1175,10 @@ def miami_draw(df_top:pd.DataFrame, df_bottom:pd.DataFrame, snp_col:str, chr_col
         )
     
     # save ad show the plot
-    plt.savefig(os.path.join(plots_dir, save_name), dpi=500)
+    plt.savefig(os.path.join(plots_dir, save_name), dpi=dpi)
     plt.show()
 
+    # release the canvas
+    plt.close(fig)
+
     return True
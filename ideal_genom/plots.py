@@ -5,6 +5,8 @@ Functions:
 ----------
 - qqplot_draw(df_gwas: pd.DataFrame, plots_dir: str, conf_color="lightgray", save_name: str='qq_plot.jpeg') -> bool:
     Draws a QQ plot for GWAS data.
+- qq_points(pvalues: np.ndarray, grp: np.ndarray=None, log10p: np.ndarray=None) -> tuple:
+    Computes the thinned points of the QQ plot.
 - confidence_interval(n: int, conf_points: int=1500, conf_alpha: float=0.05) -> np.ndarray:
     Computes confidence intervals for the QQ plot.
 - beta_beta_draw(gwas_1: pd.DataFrame, gwas_2: pd.DataFrame, p_col: str, beta_col: str, se_col: str, snp_col: str, label_1: str, label_2: str, plot_dir: str, significance: float=5e-8, annotate_coincidents: bool=True, save_name: str='beta_beta.jpeg', draw_error_line: bool=True, draw_reg_line: bool=True) -> bool:
@@ -28,6 +30,8 @@ import textalloc as ta
 
 from matplotlib.collections import LineCollection
 
+from ideal_genom.manhattan_type import neg_log10
+
 from gwaslab.bd_download import download_file
 from gwaslab.g_Log import Log
 from gwaslab.util_in_get_sig import annogene
@@ -52,34 +56,12 @@ def qqplot_draw(df_gwas:pd.DataFrame, plots_dir:str, conf_color="lightgray", sav
     """
     
     pvalues = df_gwas['p'].values
+    log10p  = neg_log10(pvalues)
+
     grp = None
     n = len(pvalues)
 
-    log_p = -np.log10(pvalues)
-    exp_x = -np.log10((stats.rankdata(pvalues, method='ordinal') - 0.5) / n)
-
-    if grp is not None:
-
-        # Create a DataFrame with rounded pvalues and exp_x, and grp
-        thin = pd.DataFrame({
-            'pvalues': np.round(log_p, 3),
-            'exp_x': np.round(exp_x, 3),
-            'grp': grp
-        }).drop_duplicates()
-
-        # Assign the updated group after thinning
-        grp = thin['grp'].values
-    else:
-
-        # Create a DataFrame with rounded pvalues and exp_x
-        thin = pd.DataFrame({
-            'pvalues': np.round(log_p, 3),
-            'exp_x': np.round(exp_x, 3)
-        }).drop_duplicates()
-
-    # Update pvalues and exp_x after thinning
-    log_p = thin['pvalues'].values
-    exp_x = thin['exp_x'].values
+    log_p, exp_x, grp = qq_points(pvalues, grp=grp, log10p=log10p)
 
     axis_range =  [float(min(log_p.min(), exp_x.min()))-0.5, float(max(log_p.max(), exp_x.max()))+1]
 
@@ -116,6 +98,49 @@ def qqplot_draw(df_gwas:pd.DataFrame, plots_dir:str, conf_color="lightgray", sav
 
     return True
 
+def qq_points(pvalues:np.ndarray, grp:np.ndarray=None, log10p:np.ndarray=None)->tuple:
+
+    """
+    Function to compute the points of a QQ plot. Observed and expected -log10(p) values are rounded to 3 decimals and repeated points are dropped. Everything is computed in p-value order: there both coordinates are monotone, so repeated points are adjacent and thinning is a single comparison with the previous point.
+
+    Parameters:
+    -----------
+    pvalues : np.ndarray
+        Array of p-values.
+    grp : np.ndarray (default=None)
+        Optional group of each p-value. Points are only dropped when repeated within a group.
+    log10p : np.ndarray (default=None)
+        Optional precomputed -log10 of the p-values, e.g. from `neg_log10`.
+
+    Returns:
+    --------
+    tuple
+        Observed and expected -log10(p) values, and the group of each point (None if `grp` is None).
+    """
+
+    n = len(pvalues)
+
+    # sorting once gives the ordinal ranks (ties broken by order of appearance)
+    order = np.argsort(pvalues, kind='stable')
+
+    # rounded values in units of 1e-3
+    if log10p is None:
+        lp_i = np.round(-np.log10(pvalues[order]) * 1000).astype(np.int64)
+    else:
+        lp_i = np.round(np.asarray(log10p)[order].astype(np.float64) * 1000).astype(np.int64)
+    ex_i = np.round(-np.log10((np.arange(1, n + 1) - 0.5) / n) * 1000).astype(np.int64)
+
+    if grp is not None:
+        # points of different groups are interleaved, thin on unique (pvalues, exp_x, grp) triplets
+        grp = np.asarray(grp)[order]
+        keep = ~pd.MultiIndex.from_arrays([lp_i, ex_i, pd.factorize(grp)[0]]).duplicated()
+        grp  = grp[keep]
+    else:
+        keep = np.ones(n, dtype=bool)
+        keep[1:] = (lp_i[1:] != lp_i[:-1]) | (ex_i[1:] != ex_i[:-1])
+
+    return lp_i[keep] / 1000, ex_i[keep] / 1000, grp
+
 def confidence_interval(n:int, conf_points:int=1500, conf_alpha:float=0.05)->np.ndarray:
 
     """
@@ -153,19 +178,21 @@ def confidence_interval(n:int, conf_points:int=1500, conf_alpha:float=0.05)->np.
         raise ValueError(f"conf_alpha must be between 0 and 1.")
     
     conf_points = min(conf_points, n - 1)
-    mpts = np.zeros((conf_points * 2, 2))
+    mpts = np.empty((conf_points * 2, 2))
 
-    for i in range(1, conf_points + 1):
-        x = -np.log10((i - 0.5) / n)
-        
-        y_upper = -np.log10(stats.beta.ppf(1 - conf_alpha / 2, i, n - i))
-        y_lower = -np.log10(stats.beta.ppf(conf_alpha / 2, i, n - i))
-        
-        mpts[i - 1, 0] = x
-        mpts[i - 1, 1] = y_upper
-        
-        mpts[conf_points * 2 - i, 0] = x
-        mpts[conf_points * 2 - i, 1] = y_lower
+    i = np.arange(1, conf_points + 1)
+    x = -np.log10((i - 0.5) / n)
+
+    # both bounds in a single call broadcasting the two tail probabilities against the ranks,
+    # isf(alpha/2) is ppf(1 - alpha/2) without the rounding of 1 - alpha/2
+    y_upper, y_lower = -np.log10(stats.beta.isf([[conf_alpha / 2], [1 - conf_alpha / 2]], i, n - i))
+
+    # upper bound from left to right, then lower bound back from right to left
+    mpts[:conf_points, 0] = x
+    mpts[:conf_points, 1] = y_upper
+
+    mpts[conf_points:, 0] = x[::-1]
+    mpts[conf_points:, 1] = y_lower[::-1]
     
     return mpts
 
@@ -378,15 +405,9 @@ def beta_beta_draw(gwas_1:pd.DataFrame, gwas_2:pd.DataFrame, p_col:str, beta_col
     if annotate_coincidents:
         to_annotate = df[df[f'P-val<{significance}']=='Both'].reset_index(drop=True)
         
-        texts=[]
-        text_x = []
-        text_y = []
-
-        for i, row in to_annotate.iterrows():
-
-            texts.append(row[snp_col])
-            text_x.append(row[f'{beta_col}_1'])
-            text_y.append(row[f'{beta_col}_2'])
+        texts  = to_annotate[snp_col].to_list()
+        text_x = to_annotate[f'{beta_col}_1'].to_list()
+        text_y = to_annotate[f'{beta_col}_2'].to_list()
 
         ta.allocate(
                 ax,
@@ -699,15 +720,9 @@ def trumpet_draw(df_gwas:pd.DataFrame, df_freq:pd.DataFrame, plot_dir:pd.DataFra
 
         for key in split.keys():
 
-            texts = []  # a list to store text annotations for adjustment
-            x = []      # a list to store x-coordinates for adjustment
-            y = []      # a list to store y-coordinates for adjustment
-
-            for i, row in split[key].iterrows():
-
-                x.append(row[maf_col])
-                y.append(row[beta_col])
-                texts.append(row['GENENAME'])
+            texts = split[key]['GENENAME'].to_list() # text annotations for adjustment
+            x     = split[key][maf_col].to_list()    # x-coordinates for adjustment
+            y     = split[key][beta_col].to_list()   # y-coordinates for adjustment
 
             if key == 'top':
                 direction = 'northeast'
@@ -9,10 +9,374 @@ PrepDS
     Class to perform data preparation for downstream analysis.
 """
 
+import hashlib
 import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from scipy import linalg
+from scipy.stats import chi2
 
 from ideal_genom.Helpers import shell_do, delete_temp_files
 
+# number of A1 alleles encoded by each 2-bit genotype code of a PLINK .bed file (01 is missing)
+_BED_CODE_DOSAGE = np.array([2.0, np.nan, 1.0, 0.0], dtype=np.float32)
+
+# the four 2-bit genotype codes packed (low bits first) in every possible .bed byte
+_BED_BYTE_CODES = ((np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 3).astype(np.uint8)
+
+# dosages of the four genotypes packed in every possible .bed byte
+_BED_BYTE_DOSAGE = _BED_CODE_DOSAGE[_BED_BYTE_CODES]
+
+def _fingerprint(files:list, params:list)->str:
+
+    """
+    Fingerprint of a pipeline step, built from the size and modification time of its input files and from its parameters.
+    """
+
+    parts = [f'{os.path.getmtime(file)}:{os.path.getsize(file)}' for file in files] + [str(param) for param in params]
+
+    return hashlib.sha256(':'.join(parts).encode()).hexdigest()[:16]
+
+def _file_stamps(files:list)->dict:
+
+    """
+    Modification time in ns, size and inode of each file, None for the files that do not exist. Comparing the stamps taken before and after a step tells which files it wrote, whatever the mtime granularity of the filesystem.
+    """
+
+    stamps = dict()
+    for file in files:
+        try:
+            stat = os.stat(file)
+            stamps[file] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            stamps[file] = None
+
+    return stamps
+
+def _available_memory()->int:
+
+    """
+    Memory in MB available to the process: `MemAvailable` of /proc/meminfo (free memory plus reclaimable page cache), capped by the room left under the cgroup memory limit when running in a container or a batch job. Returns None when it cannot be queried on the platform.
+    """
+
+    try:
+        with open('/proc/meminfo') as f:
+            meminfo = dict(line.split(':', 1) for line in f if ':' in line)
+        available = int(meminfo['MemAvailable'].split()[0]) * 1024
+    except (OSError, KeyError, ValueError, IndexError):
+        return None
+
+    # cgroup v2 first, then v1; an unlimited v2 group reads 'max'
+    cgroup_files = [
+        ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+        ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes'),
+    ]
+    for limit_file, usage_file in cgroup_files:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+        if limit.isdigit():
+            available = min(available, int(limit) - usage)
+        break
+
+    return max(available, 0) // 1024**2
+
+def _allowed_cpus()->int:
+
+    """
+    Number of threads to give to plink: the CPUs the process is allowed to run on, which in containers and batch jobs can be far fewer than the host's, leaving one free.
+    """
+
+    try:
+        return max(1, len(os.sched_getaffinity(0))-1)
+    except AttributeError:
+        return max(1, (os.cpu_count() or 12)-2)
+
+def _open_bed(bed_file:str, n_samples:int, n_snps:int)->np.memmap:
+
+    """
+    Memory-map a SNP-major PLINK .bed file as a (n_snps, bytes_per_snp) array of packed genotypes.
+    """
+
+    with open(bed_file, 'rb') as f:
+        magic = f.read(3)
+    if magic != b'\x6c\x1b\x01':
+        raise ValueError(f"File is not a SNP-major PLINK bed file: {bed_file}")
+
+    return np.memmap(bed_file, dtype=np.uint8, mode='r', offset=3, shape=(n_snps, (n_samples+3)//4))
+
+def _block_snps(n_samples:int, max_snps:int, block_bytes:int=2**26)->int:
+
+    """
+    Number of SNPs to decode at a time so that a block of float32 genotypes takes at most `block_bytes`, whatever the number of samples, and no more than `max_snps`.
+    """
+
+    return max(1, min(max_snps, block_bytes // (4*n_samples)))
+
+def _standardized_block(packed:np.ndarray, n_samples:int)->np.ndarray:
+
+    """
+    Decode a block of packed SNPs into a (n_snps, n_samples) float32 array, centered and scaled per SNP as in PLINK's GRM. Missing genotypes are mean-imputed.
+    The allele frequencies are taken from the genotype counts, so the only float array allocated is the returned one.
+    """
+
+    hom1, _, het, hom2 = _genotype_counts(packed, n_samples).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        freq = ((2*hom1 + het) / (2*(hom1 + het + hom2)))[:, None]
+    freq = np.nan_to_num(freq, nan=0.0)
+
+    geno = _BED_BYTE_DOSAGE[packed].reshape(packed.shape[0], -1)[:, :n_samples]
+
+    std  = np.sqrt(2*freq*(1-freq))
+    std[std == 0] = 1
+
+    geno -= 2*freq
+    geno /= std
+
+    return np.nan_to_num(geno, copy=False, nan=0.0)
+
+def _dosage_block(packed:np.ndarray, n_samples:int)->tuple:
+
+    """
+    Decode a block of packed SNPs into (n_snps, n_samples) float32 arrays of dosages, zero where missing, and of non-missing indicators.
+    """
+
+    geno = _BED_BYTE_DOSAGE[packed].reshape(packed.shape[0], -1)[:, :n_samples]
+    mask = ~np.isnan(geno)
+
+    return np.where(mask, geno, 0), mask.astype(np.float32)
+
+def _genotype_counts(packed:np.ndarray, n_samples:int, samples:np.ndarray=None)->np.ndarray:
+
+    """
+    Count the genotype codes of a block of packed SNPs over all samples, or over the given sample indices. Returns a (n_snps, 4) array with the counts of hom A1, missing, het and hom A2 genotypes.
+    """
+
+    codes = _BED_BYTE_CODES[packed].reshape(packed.shape[0], -1)[:, :n_samples]
+
+    if samples is not None:
+        codes = codes[:, samples]
+
+    return np.stack([(codes == code).sum(axis=1) for code in range(4)], axis=1)
+
+def _founders(fam:pd.DataFrame)->np.ndarray:
+
+    """
+    Indices of the founders of a fam file, the samples without parents in the data set. As PLINK 1.9 with `--nonfounders`, all samples are used when there is none.
+    """
+
+    founders = np.flatnonzero(((fam[2] == '0') & (fam[3] == '0')).values)
+
+    return founders if len(founders) > 0 else np.arange(fam.shape[0])
+
+def _hwe_window(n:np.ndarray, rare:np.ndarray, het:np.ndarray, lo:np.ndarray, hi:np.ndarray, max_cells:int)->tuple:
+
+    """
+    Hardy-Weinberg exact test p-values summing the probabilities of the heterozygote counts from `lo` to `hi` only. Also flags the SNPs for which the probabilities at the window edges are not negligible.
+    SNPs are processed in chunks of similar window width of at most `max_cells` values.
+    """
+
+    pvalues   = np.ones(len(n))
+    truncated = np.zeros(len(n), dtype=bool)
+
+    # heterozygote counts have the parity of the rare allele count
+    width = (hi - lo) // 2 + 1
+    order = np.argsort(width, kind='stable')
+
+    start = 0
+    while start < len(order):
+
+        rows = max(1, max_cells // width[order[min(start + max_cells // width[order[start]], len(order)) - 1]])
+        snps = order[start:start+rows]
+        start += rows
+
+        n_c, rare_c, lo_c = n[snps, None], rare[snps, None], lo[snps, None]
+
+        hets  = lo_c + 2*np.arange(width[snps].max())
+        valid = hets <= hi[snps, None]
+
+        # log-probabilities relative to the window start, from Wigginton's ratio P(h+2)/P(h) = 4 hom_rare hom_common / ((h+1)(h+2))
+        hom_rare   = np.maximum((rare_c - hets[:, :-1]) // 2, 1)
+        hom_common = np.maximum(n_c - hom_rare - hets[:, :-1], 1)
+
+        ratio = np.log(4.0*hom_rare*hom_common / ((hets[:, :-1]+1.0)*(hets[:, :-1]+2.0)))
+
+        logp = np.zeros(hets.shape)
+        np.cumsum(np.where(valid[:, 1:], ratio, 0), axis=1, out=logp[:, 1:])
+        logp[~valid] = -np.inf
+
+        obs = np.take_along_axis(logp, (het[snps, None] - lo_c) // 2, axis=1)
+
+        top  = logp.max(axis=1, keepdims=True)
+        prob = np.exp(logp - top)
+        tail = np.where(logp <= obs + 1e-7, prob, 0).sum(axis=1)
+
+        pvalues[snps] = tail / prob.sum(axis=1)
+
+        # the window missed part of the distribution when an edge inside the range of heterozygote counts is not negligible
+        edge_lo = np.where(lo[snps] > rare[snps] % 2, prob[:, 0], 0)
+        edge_hi = np.where(hi[snps] < rare[snps], prob[np.arange(len(snps)), width[snps]-1], 0)
+
+        truncated[snps] = np.maximum(edge_lo, edge_hi) > 1e-12 * tail
+
+    return pvalues, truncated
+
+def _hwe_exact(het:np.ndarray, hom1:np.ndarray, hom2:np.ndarray, max_cells:int=2**22)->np.ndarray:
+
+    """
+    Hardy-Weinberg equilibrium exact test (Wigginton et al., 2005) for arrays of genotype counts, as PLINK's --hwe.
+    The probabilities of the heterozygote counts of many SNPs are evaluated at once, only around the mode and the observed count: the standard deviation of the count is close to mode/sqrt(n), so beyond 8 of them the probabilities are negligible. SNPs for which this window is too narrow are computed over all heterozygote counts.
+    """
+
+    het  = np.asarray(het, dtype=np.int64)
+    hom1 = np.asarray(hom1, dtype=np.int64)
+    hom2 = np.asarray(hom2, dtype=np.int64)
+
+    n    = het + hom1 + hom2
+    rare = np.minimum(2*hom1+het, 2*hom2+het)
+
+    if len(n) == 0:
+        return np.ones(0)
+
+    # mode of the heterozygote count (Wigginton et al.), with the parity of the rare allele count
+    mode  = rare*(2*n - rare) // np.maximum(2*n, 1)
+    mode += (rare - mode) % 2
+
+    # window around the mode covering the observed count, mirrored for the tail on the other side
+    dist = np.abs(het - mode) + 8*np.ceil(mode / np.sqrt(np.maximum(n, 1)) + 1).astype(np.int64)
+
+    lo = mode - dist
+    lo = np.maximum(lo + (lo - rare) % 2, rare % 2)
+    hi = mode + dist
+    hi = np.minimum(hi - (hi - rare) % 2, rare)
+
+    pvalues, truncated = _hwe_window(n, rare, het, lo, hi, max_cells)
+
+    # all the heterozygote counts for the few SNPs where the window was too narrow
+    if truncated.any():
+        full = np.flatnonzero(truncated)
+        pvalues[full], _ = _hwe_window(n[full], rare[full], het[full], rare[full] % 2, rare[full], max_cells)
+
+    return np.minimum(pvalues, 1)
+
+def _hwe_filter_pvalues(het:np.ndarray, hom1:np.ndarray, hom2:np.ndarray, threshold:float)->np.ndarray:
+
+    """
+    Hardy-Weinberg p-values to filter SNPs at `threshold`. SNPs with all expected genotype counts of at least 100 and a chi-square p-value above max(1e-3, 1000*threshold) keep the chi-square p-value: there the exact p-value is not below half of it (checked on simulated data), so the filter decision is the same. The exact test is run on all other SNPs.
+    """
+
+    het  = np.asarray(het, dtype=np.float64)
+    hom1 = np.asarray(hom1, dtype=np.float64)
+    hom2 = np.asarray(hom2, dtype=np.float64)
+
+    n    = het + hom1 + hom2
+    freq = (2*hom1 + het) / np.maximum(2*n, 1)
+
+    expected = np.stack([n*freq**2, 2*n*freq*(1-freq), n*(1-freq)**2])
+
+    pvalues = np.zeros(len(n))
+
+    screen = expected.min(axis=0) >= 100
+    stat   = (((np.stack([hom1, het, hom2])[:, screen] - expected[:, screen])**2) / expected[:, screen]).sum(axis=0)
+
+    pvalues[screen] = chi2.sf(stat, 1)
+
+    exact = ~screen | (pvalues < max(1e-3, 1000*threshold))
+
+    pvalues[exact] = _hwe_exact(het[exact].astype(np.int64), hom1[exact].astype(np.int64), hom2[exact].astype(np.int64))
+
+    return pvalues
+
+def _pair_r2(dosage_a:np.ndarray, mask_a:np.ndarray, dosage_b:np.ndarray, mask_b:np.ndarray)->np.ndarray:
+
+    """
+    Squared correlation between every SNP of block a and every SNP of block b, each pair computed over the samples called for both SNPs as PLINK does.
+    """
+
+    # pairwise sums over the samples called for both SNPs, as dot products of the dosages and non-missing indicators.
+    # The sums are integers below 2**24, hence exact in float32, the differences below are taken in float64
+    n   = (mask_a @ mask_b.T).astype(np.float64)
+    sx  = (dosage_a @ mask_b.T).astype(np.float64)
+    sy  = (mask_a @ dosage_b.T).astype(np.float64)
+    sxx = ((dosage_a*dosage_a) @ mask_b.T).astype(np.float64)
+    syy = (mask_a @ (dosage_b*dosage_b).T).astype(np.float64)
+    sxy = (dosage_a @ dosage_b.T).astype(np.float64)
+
+    cov = n*sxy - sx*sy
+    var = (n*sxx - sx**2) * (n*syy - sy**2)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = cov**2 / var
+
+    return np.nan_to_num(r2, nan=0.0, posinf=0.0)
+
+def _ld_prune(bed:np.ndarray, n_samples:int, snp_idx:np.ndarray, chrom:np.ndarray, window:int, step:int, r2_threshold:float, samples:np.ndarray=None)->np.ndarray:
+
+    """
+    Greedy LD pruning in sliding windows of `window` SNPs shifted by `step` SNPs, as PLINK's --indep-pairwise. Within a window, of every pair of remaining SNPs with r2 above the threshold the one with the lower MAF is pruned.
+    Windows do not cross chromosomes. The r2 and MAF are computed over all samples, or over the given sample indices. Returns a boolean mask over `snp_idx` of the SNPs kept.
+
+    The genotypes and r2 of the SNPs still in the window are carried over when it slides, so only the pairs involving the SNPs entering the window are computed.
+    """
+
+    pruned = np.zeros(len(snp_idx), dtype=bool)
+
+    bounds = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+
+    for chr_start, chr_end in zip(np.r_[0, bounds], np.r_[bounds, len(snp_idx)]):
+
+        # SNPs of the previous window that were not pruned, with their genotypes, MAF and r2
+        cached = np.arange(0)
+        dosage = mask = np.empty((0, n_samples if samples is None else len(samples)), dtype=np.float32)
+        maf    = np.empty(0)
+        r2     = np.empty((0, 0))
+
+        for win_start in range(chr_start, chr_end, step):
+
+            win_end = min(win_start+window, chr_end)
+
+            active = np.arange(win_start, win_end)
+            active = active[~pruned[active]]
+
+            # SNPs that left the window or were pruned are dropped, new SNPs always come after the cached ones
+            stay   = np.isin(cached, active)
+            n_stay = stay.sum()
+            fresh  = active[n_stay:]
+
+            new_dosage, new_mask = _dosage_block(bed[snp_idx[fresh]], n_samples)
+            if samples is not None:
+                new_dosage, new_mask = new_dosage[:, samples], new_mask[:, samples]
+
+            freq = new_dosage.sum(axis=1) / np.maximum(2*new_mask.sum(axis=1), 1)
+
+            dosage = np.concatenate([dosage[stay], new_dosage])
+            mask   = np.concatenate([mask[stay], new_mask])
+            maf    = np.concatenate([maf[stay], np.minimum(freq, 1-freq)])
+
+            cross = _pair_r2(dosage, mask, new_dosage, new_mask)
+            r2    = np.block([[r2[np.ix_(stay, stay)], cross[:n_stay]], [cross[:n_stay].T, cross[n_stay:]]])
+
+            cached = active
+
+            # only pairs above the threshold matter, visited in the same order as a nested loop over the window
+            for i, j in np.argwhere(np.triu(r2 > r2_threshold, k=1)):
+                if pruned[active[i]] or pruned[active[j]]:
+                    continue
+                pruned[active[i] if maf[i] < maf[j] else active[j]] = True
+
+            if win_end == chr_end:
+                break
+
+    return ~pruned
+
 class PrepDS:
 
     """
@@ -61,13 +425,11 @@ class PrepDS:
         if not isinstance(input_name, str) or not isinstance(output_name, str):
             raise TypeError("input_name and output_name should be of type str.")
         
-        # check existence of PLINK files
-        if not os.path.exists(os.path.join(input_path, input_name+'.bed')):
-            raise FileNotFoundError(f"PLINK bed file was not found: {os.path.join(input_path, input_name+'.bed')}")
-        if not os.path.exists(os.path.join(input_path, input_name+'.bim')):
-            raise FileNotFoundError(f"PLINK bim file was not found: {os.path.join(input_path, input_name+'.bim')}")
-        if not os.path.exists(os.path.join(input_path, input_name+'.fam')):
-            raise FileNotFoundError(f"PLINK fam file was not found: {os.path.join(input_path, input_name+'.fam')}")
+        # check existence of PLINK files, listing the input folder once
+        input_entries = {entry.name for entry in os.scandir(input_path)}
+        for ext in ['bed', 'bim', 'fam']:
+            if input_name+'.'+ext not in input_entries:
+                raise FileNotFoundError(f"PLINK {ext} file was not found: {os.path.join(input_path, input_name+'.'+ext)}")
         
         # check if config_dict is set and give a default value
         if config_dict is None:
@@ -77,7 +439,8 @@ class PrepDS:
                 'mind': 0.1,
                 'hwe': 0.00000005,
                 'indep-pairwise': [50, 5, 0.2],
-                'pca': 10
+                'pca': 10,
+                'pca_method': 'plink'
             }
 
         if not isinstance(config_dict, dict):
@@ -98,8 +461,7 @@ class PrepDS:
 
         # create results folder
         self.results_dir = os.path.join(output_path, 'preparatory')
-        if not os.path.exists(self.results_dir):
-            os.mkdir(self.results_dir)
+        os.makedirs(self.results_dir, exist_ok=True)
 
         pass
 
@@ -127,6 +489,8 @@ class PrepDS:
         hwe      = self.config_dict['hwe']
         ind_pair = self.config_dict['indep-pairwise']
 
+        prune_method = self.config_dict.get('prune_method', 'plink')
+
         # Check type of maf
         if not isinstance(maf, float):
              raise TypeError("maf should be of type float.")
@@ -158,6 +522,14 @@ class PrepDS:
         # Check if hwe is in range
         if hwe < 0 or hwe > 1:
             raise ValueError("hwe should be between 0 and 1")
+
+        # Check prune_method
+        if prune_method not in ['plink', 'inprocess']:
+            raise ValueError("prune_method should be one of 'plink' or 'inprocess'.")
+
+        # the in-process pruning uses windows of a number of SNPs
+        if prune_method == 'inprocess' and (not isinstance(ind_pair[0], int) or not isinstance(ind_pair[1], int)):
+            raise TypeError("indep-pairwise window and step should be of type int when prune_method is 'inprocess'.")
         
         # check existence of high LD regions file
         high_ld_regions_file = os.path.join(dependables_path, 'high-LD-regions.txt')
@@ -166,27 +538,56 @@ class PrepDS:
 
         step = "ld_prune"
 
+        # skip the step if its outputs were computed from the same inputs and parameters
+        input_files = [os.path.join(input_path, input_name+ext) for ext in ['.bed', '.bim', '.fam']] + [high_ld_regions_file]
+        output_files= [os.path.join(results_dir, output_name+'_LDpruned'+ext) for ext in ['.bed', '.bim', '.fam']]
+        fp_file     = os.path.join(results_dir, output_name+'_LDpruned.fp')
+
+        fingerprint = _fingerprint(input_files, [maf, geno, mind, hwe, ind_pair, prune_method])
+
+        if recompute and self._is_up_to_date(fp_file, fingerprint, output_files):
+            recompute = False
+
         # compute the number of threads to use
-        if os.cpu_count() is not None:
-            max_threads = os.cpu_count()-2
-        else:
-            max_threads = 10
+        max_threads = _allowed_cpus()
+
+        # give plink most of the available memory, or leave plink its own default when too little is reported to be trusted
+        memory = _available_memory()
+        memory_flag = f"--memory {int(memory*0.8)}" if memory and memory*0.8 >= 256 else ""
 
         if recompute:
-            # plink command to exclude high LD regions
-            plink_cmd1 = f"plink --bfile {os.path.join(input_path, input_name)} --chr 1-22 --maf {maf} --geno {geno}  --hwe {hwe} --exclude {high_ld_regions_file} --range --indep-pairwise {ind_pair[0]} {ind_pair[1]} {ind_pair[2]} --threads {max_threads} --make-bed --out {os.path.join(results_dir, output_name+'_prunning')}"
+            before = _file_stamps(output_files)
+
+            # LD is estimated on founders, few of them give unreliable r2 (plink2 refuses to prune below 50 without --bad-ld, hence PLINK 1.9 below)
+            fam = pd.read_csv(os.path.join(input_path, input_name+'.fam'), sep=r'\s+', header=None, dtype=str, usecols=[2, 3])
+            n_founders = ((fam[2] == '0') & (fam[3] == '0')).sum()
+            if n_founders < 50:
+                warnings.warn(f"Only {n_founders} founders in {input_name}.fam, the LD estimates of the pruning may be unreliable.")
 
-            # plink command to perform LD pruning
-            plink_cmd2 = f"plink2 --bfile {os.path.join(results_dir, output_name+'_prunning')} --extract {os.path.join(results_dir, output_name+'_prunning.prune.in')} --make-bed --out {os.path.join(results_dir, output_name+'_LDpruned')} --threads {max_threads}"
+            # without founders, all samples are used as by the in-process path
+            founders_flag = "" if n_founders else "--nonfounders"
 
-            # execute plink commands
-            cmds = [plink_cmd1, plink_cmd2]
-            for cmd in cmds:
-                shell_do(cmd, log=True)
+            if prune_method == 'plink':
+                # plink command to filter SNPs, exclude high LD regions and find the pruned SNPs, no intermediate bed is written
+                plink_cmd1 = f"plink --bfile {os.path.join(input_path, input_name)} --chr 1-22 --maf {maf} --geno {geno} --hwe {hwe} --exclude {high_ld_regions_file} --range {founders_flag} --indep-pairwise {ind_pair[0]} {ind_pair[1]} {ind_pair[2]} --threads {max_threads} {memory_flag} --out {os.path.join(results_dir, output_name+'_prunning')}"
+
+                # plink command to extract the pruned SNPs from the input data, the filters are repeated so that variants failing them cannot be pulled back in through duplicated or missing IDs
+                plink_cmd2 = f"plink --bfile {os.path.join(input_path, input_name)} --chr 1-22 --maf {maf} --geno {geno} --hwe {hwe} --exclude {high_ld_regions_file} --range {founders_flag} --extract {os.path.join(results_dir, output_name+'_prunning.prune.in')} --make-bed --out {os.path.join(results_dir, output_name+'_LDpruned')} --threads {max_threads} {memory_flag}"
+
+                # execute plink commands
+                cmds = [plink_cmd1, plink_cmd2]
+                for cmd in cmds:
+                    shell_do(cmd, log=True)
+            else:
+                # QC filters, LD pruning and extraction of the pruned SNPs straight from the input bed, without plink
+                self._prune_inprocess(maf, geno, hwe, ind_pair[0], ind_pair[1], ind_pair[2], high_ld_regions_file)
+
+            self._save_fingerprint(fp_file, fingerprint, output_files, before)
 
         self.files_to_keep.append(output_name+'_LDpruned.bed')
         self.files_to_keep.append(output_name+'_LDpruned.bim')
         self.files_to_keep.append(output_name+'_LDpruned.fam')
+        self.files_to_keep.append(output_name+'_LDpruned.fp')
 
         # report
         process_complete = True
@@ -218,33 +619,57 @@ class PrepDS:
         output_name = self.output_name
         recompute   = self.recompute
 
-        pca = self.config_dict['pca']
+        pca        = self.config_dict['pca']
+        pca_method = self.config_dict.get('pca_method', 'plink')
 
         # Check type of pca and range
         if not isinstance(pca, int):
             raise TypeError("pca should be of type int.")
         if pca < 1:
             raise ValueError("pca should be greater than 0.")
+        
+        # Check pca_method
+        if pca_method not in ['plink', 'randomized', 'svd']:
+            raise ValueError("pca_method should be one of 'plink', 'randomized' or 'svd'.")
 
         step = "pca_decomposition"
 
+        # skip the step if its outputs were computed from the same inputs and parameters
+        input_files = [os.path.join(results_dir, output_name+'_LDpruned'+ext) for ext in ['.bed', '.bim', '.fam']]
+        output_files= [os.path.join(results_dir, output_name+'_pca.eigenvec')]
+        fp_file     = os.path.join(results_dir, output_name+'_pca.fp')
+
+        if recompute and all(os.path.exists(file) for file in input_files):
+            fingerprint = _fingerprint(input_files, [pca, pca_method])
+            if self._is_up_to_date(fp_file, fingerprint, output_files):
+                recompute = False
+
         # compute the number of threads to use
-        if os.cpu_count() is not None:
-            max_threads = os.cpu_count()-2
-        else:
-            max_threads = 10
+        max_threads = _allowed_cpus()
 
         if recompute:
+            before = _file_stamps(output_files)
+
             if not os.path.exists(os.path.join(results_dir, output_name+'_LDpruned.bed')):
                 raise FileNotFoundError(f"File with pruned data was not found: {os.path.join(results_dir, output_name+'_LDpruned')}")
 
-            # plink command to perform PCA decomposition
-            plink_cmd = f"plink --bfile {os.path.join(results_dir, output_name+'_LDpruned')} --pca {pca} --threads {max_threads} --out {os.path.join(results_dir, output_name+'_pca')}"
+            if pca_method == 'randomized':
+                # in-process randomized SVD on the memory-mapped pruned data
+                self._pca_randomized(pca)
+            elif pca_method == 'svd':
+                # in-process exact SVD of the standardized pruned data
+                self._pca_svd(pca)
+            else:
+                # plink command to perform PCA decomposition
+                plink_cmd = f"plink --bfile {os.path.join(results_dir, output_name+'_LDpruned')} --pca {pca} --threads {max_threads} --out {os.path.join(results_dir, output_name+'_pca')}"
+
+                # execute plink command
+                shell_do(plink_cmd, log=True)
 
-            # execute plink command
-            shell_do(plink_cmd, log=True)
+            self._save_fingerprint(fp_file, _fingerprint(input_files, [pca, pca_method]), output_files, before)
 
         self.files_to_keep.append(output_name+'_pca.eigenvec')
+        self.files_to_keep.append(output_name+'_pca.fp')
 
         # delete temporary files
         delete_temp_files(self.files_to_keep, results_dir)
@@ -263,3 +688,256 @@ class PrepDS:
         }
 
         return out_dict
+
+    def _pca_randomized(self, k:int, oversamples:int=10, n_iter:int=2, block_size:int=1024, seed:int=42)->None:
+
+        """
+        Compute the top principal components of the LD pruned data with a randomized SVD (Halko et al., 2011). The genotypes are streamed in blocks of SNPs from a memory-mapped .bed file, so the full genotype matrix is never loaded. Results are written in PLINK format (`_pca.eigenvec` and `_pca.eigenval`).
+
+        Parameters:
+        -----------
+        k : int
+            Number of principal components.
+        oversamples : int (default=10)
+            Number of extra random directions used to capture the range of the data.
+        n_iter : int (default=2)
+            Number of power iterations, improves accuracy when the spectrum decays slowly.
+        block_size : int (default=1024)
+            Maximum number of SNPs decoded at a time, lowered so that a decoded block takes at most 64 MB.
+        seed : int (default=42)
+            Seed for the random projection.
+
+        Returns:
+        --------
+        None
+        """
+
+        fam, bed = self._open_pruned()
+
+        n_samples, n_snps = fam.shape[0], bed.shape[0]
+
+        k = min(k, n_samples, n_snps)
+        l = min(k+oversamples, n_samples, n_snps)
+
+        block_size = _block_snps(n_samples, block_size)
+
+        # A is the standardized (samples x SNPs) genotype matrix, each block G holds A[:, block].T
+        blocks = [(start, min(start+block_size, n_snps)) for start in range(0, n_snps, block_size)]
+
+        # range finder: Y = A @ Omega
+        omega = np.random.default_rng(seed).standard_normal((n_snps, l)).astype(np.float32)
+
+        Y = np.zeros((n_samples, l))
+        for start, end in blocks:
+            G = _standardized_block(bed[start:end], n_samples)
+            Y += G.T @ omega[start:end]
+
+        Q, _ = linalg.qr(Y, mode='economic')
+
+        # power iterations: Y = A @ A.T @ Q, both products in a single pass over the data
+        for _ in range(n_iter):
+            Q32 = Q.astype(np.float32)
+            Y = np.zeros((n_samples, l))
+            for start, end in blocks:
+                G = _standardized_block(bed[start:end], n_samples)
+                Y += G.T @ (G @ Q32)
+            Q, _ = linalg.qr(Y, mode='economic')
+
+        # project the data onto the range: B = Q.T @ A
+        Q32 = Q.astype(np.float32)
+        B = np.empty((l, n_snps), dtype=np.float32)
+        for start, end in blocks:
+            G = _standardized_block(bed[start:end], n_samples)
+            B[:, start:end] = (G @ Q32).T
+
+        Ub, S, _ = linalg.svd(B, full_matrices=False, lapack_driver='gesdd')
+
+        del bed
+
+        self._write_pca(fam, Q @ Ub[:, :k], S[:k]**2 / n_snps)
+
+        pass
+
+    def _pca_svd(self, k:int, block_size:int=1024)->None:
+
+        """
+        Compute the top principal components of the LD pruned data with a direct SVD of the standardized genotype matrix, avoiding the loss of precision of forming the covariance matrix. The matrix is held in float32 to halve its memory footprint. Results are written in PLINK format (`_pca.eigenvec` and `_pca.eigenval`).
+
+        Parameters:
+        -----------
+        k : int
+            Number of principal components.
+        block_size : int (default=1024)
+            Maximum number of SNPs decoded at a time, lowered so that a decoded block takes at most 64 MB.
+
+        Returns:
+        --------
+        None
+        """
+
+        fam, bed = self._open_pruned()
+
+        n_samples, n_snps = fam.shape[0], bed.shape[0]
+
+        k = min(k, n_samples, n_snps)
+
+        block_size = _block_snps(n_samples, block_size)
+
+        # standardized (samples x SNPs) genotype matrix
+        A = np.empty((n_samples, n_snps), dtype=np.float32)
+        for start in range(0, n_snps, block_size):
+            end = min(start+block_size, n_snps)
+            A[:, start:end] = _standardized_block(bed[start:end], n_samples).T
+
+        del bed
+
+        U, S, _ = linalg.svd(A, full_matrices=False, lapack_driver='gesdd', overwrite_a=True, check_finite=False)
+
+        self._write_pca(fam, U[:, :k], S[:k]**2 / n_snps)
+
+        pass
+
+    def _prune_inprocess(self, maf:float, geno:float, hwe:float, window:int, step:int, r2_threshold:float, high_ld_regions_file:str, block_size:int=1024)->None:
+
+        """
+        In-process equivalent of the plink commands of the LD pruning step. Keeps the SNPs of chromosomes 1-22 outside the high LD regions, filters them by missingness, MAF and HWE in a single streaming pass over the memory-mapped input bed, prunes them as `PLINK --indep-pairwise` and writes the `_LDpruned` bed, bim and fam files by copying the packed rows of the kept SNPs.
+
+        As in PLINK 1.9, allele frequencies and r2 are computed on founders and the HWE test on founders that are controls when the phenotype is case/control.
+        """
+
+        prefix = os.path.join(self.input_path, self.input_name)
+        out    = os.path.join(self.results_dir, self.output_name)
+
+        fam = pd.read_csv(prefix+'.fam', sep=r'\s+', header=None, dtype=str)
+        bim = pd.read_csv(prefix+'.bim', sep=r'\s+', header=None, dtype=str)
+
+        n_samples = fam.shape[0]
+
+        bed = _open_bed(prefix+'.bed', n_samples, bim.shape[0])
+
+        # autosomes outside the high LD regions, ranges are inclusive as in plink --range
+        chrom = pd.to_numeric(bim[0].str.replace('chr', '', regex=False), errors='coerce').values
+        pos   = bim[3].astype(np.int64).values
+
+        candidate = (chrom >= 1) & (chrom <= 22)
+
+        ranges = pd.read_csv(high_ld_regions_file, sep=r'\s+', header=None, usecols=[0, 1, 2], dtype=str)
+        ranges[0] = pd.to_numeric(ranges[0].str.replace('chr', '', regex=False), errors='coerce')
+
+        for chr_range, range_start, range_end in ranges.itertuples(index=False):
+            candidate &= ~((chrom == chr_range) & (pos >= int(range_start)) & (pos <= int(range_end)))
+
+        snp_idx = np.flatnonzero(candidate)
+
+        # founders, and founder controls when the phenotype is case/control
+        founders = _founders(fam)
+
+        pheno = fam[5].iloc[founders]
+        if pheno[~pheno.isin(['0', '-9'])].isin(['1', '2']).all() and (pheno == '1').any():
+            controls = founders[(pheno == '1').values]
+        else:
+            controls = founders
+
+        # missingness, MAF and HWE p-value of every candidate SNP in one pass over the bed
+        missing = np.empty(len(snp_idx))
+        freq    = np.empty(len(snp_idx))
+        hwe_p   = np.empty(len(snp_idx))
+
+        for start in range(0, len(snp_idx), block_size):
+
+            block  = slice(start, start+block_size)
+            packed = bed[snp_idx[block]]
+
+            missing[block] = _genotype_counts(packed, n_samples)[:, 1] / n_samples
+
+            hom1, _, het, hom2 = _genotype_counts(packed, n_samples, founders).T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                freq[block] = (2*hom1 + het) / (2*(hom1 + het + hom2))
+
+            hom1, _, het, hom2 = _genotype_counts(packed, n_samples, controls).T
+            hwe_p[block] = _hwe_filter_pvalues(het, hom1, hom2, hwe)
+
+        minor = np.nan_to_num(np.minimum(freq, 1-freq), nan=0.0)
+
+        snp_idx = snp_idx[(missing <= geno) & (hwe_p >= hwe) & (minor >= maf)]
+
+        # LD pruning of the SNPs passing QC
+        keep = _ld_prune(bed, n_samples, snp_idx, chrom[snp_idx], window, step, r2_threshold, founders)
+
+        bim[1].iloc[snp_idx[keep]].to_csv(out+'_prunning.prune.in', header=False, index=False)
+        bim[1].iloc[snp_idx[~keep]].to_csv(out+'_prunning.prune.out', header=False, index=False)
+
+        snp_idx = snp_idx[keep]
+
+        # write the pruned data set, the packed rows are copied as they are
+        with open(out+'_LDpruned.bed', 'wb') as f:
+            f.write(b'\x6c\x1b\x01')
+            for start in range(0, len(snp_idx), block_size):
+                f.write(np.ascontiguousarray(bed[snp_idx[start:start+block_size]]).tobytes())
+
+        bim.iloc[snp_idx].to_csv(out+'_LDpruned.bim', sep='\t', header=False, index=False)
+        fam.to_csv(out+'_LDpruned.fam', sep=' ', header=False, index=False)
+
+        pass
+
+    def _is_up_to_date(self, fp_file:str, fingerprint:str, output_files:list)->bool:
+
+        """
+        Check whether the outputs of a step exist and were produced from inputs with the given fingerprint.
+        """
+
+        if not os.path.exists(fp_file) or not all(os.path.exists(file) for file in output_files):
+            return False
+
+        with open(fp_file, 'r') as f:
+            return f.read().strip() == fingerprint
+
+    def _save_fingerprint(self, fp_file:str, fingerprint:str, output_files:list, before:dict)->None:
+
+        """
+        Record the fingerprint of a step once all its outputs have been written, i.e. they exist and their stamps differ from the ones taken before the step ran (see `_file_stamps`).
+        An output rewritten within the mtime granularity with the same size and inode is taken as not written, which only costs a recomputation on the next run.
+        """
+
+        after = _file_stamps(output_files)
+
+        if all(after[file] is not None and after[file] != before.get(file) for file in output_files):
+            with open(fp_file, 'w') as f:
+                f.write(fingerprint)
+
+        pass
+
+    def _open_pruned(self)->tuple:
+
+        """
+        Read the sample identifiers of the LD pruned data and memory-map its .bed file.
+
+        Returns:
+        --------
+        tuple
+            DataFrame with FID and IID of the samples, and the memory-mapped packed genotypes.
+        """
+
+        prefix = os.path.join(self.results_dir, self.output_name+'_LDpruned')
+
+        fam = pd.read_csv(prefix+'.fam', sep=r'\s+', header=None, usecols=[0, 1], dtype=str)
+        bim = pd.read_csv(prefix+'.bim', sep=r'\s+', header=None, usecols=[1], dtype=str)
+
+        bed = _open_bed(prefix+'.bed', fam.shape[0], bim.shape[0])
+
+        return fam, bed
+
+    def _write_pca(self, fam:pd.DataFrame, eigenvec:np.ndarray, eigenval:np.ndarray)->None:
+
+        """
+        Write eigenvectors and eigenvalues with the same layout as `PLINK --pca`.
+        """
+
+        out = os.path.join(self.results_dir, self.output_name+'_pca')
+
+        df_vec = pd.concat([fam, pd.DataFrame(eigenvec)], axis=1)
+        df_vec.to_csv(out+'.eigenvec', sep=' ', header=False, index=False)
+
+        np.savetxt(out+'.eigenval', eigenval)
+
+        pass